@@ -5,7 +5,7 @@
 #   1. Function creation + renaming
 #   2. Struct types for Dart classes + typed function signatures
 #   3. EOL comments (THR fields, PP pool references)
-#   4. Selective decompilation export for signal (focus) functions
+#   4. Selective decompilation export for signal (focus) functions (parallel)
 #
 # Usage (headless):
 #   analyzeHeadless <project_dir> <project_name> \
@@ -20,15 +20,31 @@
 
 import json
 import os
+import re
+import threading
+from contextlib import contextmanager
+from Queue import Queue
 
 from ghidra.program.model.symbol import SourceType
 from ghidra.program.model.data import (
     Pointer64DataType, Pointer32DataType, PointerDataType,
     StructureDataType, CategoryPath,
 )
-from ghidra.program.model.listing import ParameterImpl
+from ghidra.program.model.listing import CodeUnit, ParameterImpl
 from ghidra.program.model.listing import Function as GhidraFunction
-from ghidra.app.decompiler import DecompInterface
+from ghidra.program.model.address import AddressSet
+from ghidra.app.cmd.disassemble import DisassembleCommand
+from ghidra.app.cmd.function import CreateFunctionCmd
+from ghidra.app.decompiler import DecompileOptions, DecompileResults
+from ghidra.app.decompiler.parallel import (
+    ParallelDecompiler, DecompilerCallback, DecompileConfigurer,
+)
+from java.util import ArrayList, HashMap
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 try:
     from ghidra.program.model.data import DataTypeConflictHandler
@@ -36,6 +52,13 @@ try:
 except:
     REPLACE_HANDLER = None
 
+# Anything but alphanumerics (unicode-aware, like str.isalnum), "_", "-", ".".
+_UNSAFE_CHARS = re.compile(r"[^\w.\-]", re.UNICODE)
+_sanitize_cache = {}
+
+# Focus functions with a larger body (in bytes) are not decompiled at all.
+MAX_DECOMPILE_SIZE = 50000
+
 
 def main():
     args = getScriptArgs()
@@ -48,11 +71,21 @@ def main():
 
     println("unflutter_apply: loading %s" % meta_path)
 
-    with open(meta_path, "r") as f:
-        meta = json.load(f)
+    meta = MetaReader(meta_path)
+    if ijson is None:
+        println("  (ijson not available; loading whole file)")
+
+    # Section handles, bound once. With ijson the file is parsed in one
+    # forward pass, so a section is streamed only if it is requested in file
+    # order; any section skipped over to reach a later one is buffered whole.
+    functions_meta = meta.items("functions")
+    classes_meta = meta.items("classes")
+    thr_meta = meta.items("thr_fields")
+    comments_meta = meta.items("comments")
+    focus_meta = meta.items("focus_functions")
 
     stats = {
-        "functions": len(meta.get("functions", [])),
+        "functions": 0,
         "renamed": 0,
         "created": 0,
         "create_failed": 0,
@@ -72,6 +105,26 @@ def main():
     image_base = currentProgram.getImageBase().getOffset()
     println("  image base: 0x%x" % image_base)
 
+    # Build Address objects straight from the default space, skipping the
+    # flat-API toAddr wrapper.
+    dspace = currentProgram.getAddressFactory().getDefaultAddressSpace()
+
+    def mkaddr(hex_addr):
+        return dspace.getAddress(int(hex_addr, 16) + image_base)
+
+    # Resolve every function address once; the phases below all walk the
+    # same list.
+    funcs = [(mkaddr(e["addr"]), e["name"], e.get("owner", ""),
+              e.get("param_count", 0), e["addr"]) for e in functions_meta]
+    stats["functions"] = len(funcs)
+    addr_by_str = dict((addr_str, addr) for (addr, _, _, _, addr_str) in funcs)
+    # addr → owner lookup for Phase 3 directory grouping. The hot lookup
+    # maps are plain java.util.HashMaps: Jython dicts box every get/put.
+    owner_by_addr = HashMap()
+    for (_, _, owner, _, addr_str) in funcs:
+        if owner:
+            owner_by_addr.put(addr_str, owner)
+
     # Determine pointer size from metadata (compressed pointers = 4 bytes).
     pointer_size = meta.get("pointer_size", 8)
     println("  pointer_size: %d" % pointer_size)
@@ -92,117 +145,171 @@ def main():
     println("Phase 1a: disassembling at %d addresses..." % stats["functions"])
     disasm_ok = 0
     disasm_fail = 0
-    for entry in meta.get("functions", []):
-        addr_int = int(entry["addr"], 16) + image_base
-        addr = toAddr(addr_int)
-        if listing.getInstructionAt(addr) is not None:
-            disasm_ok += 1
-            continue
-        try:
-            clearListing(addr)
-            disassemble(addr)
+    with bulk(currentProgram, "unflutter: disassemble"):
+        pending = []
+        for (addr, _, _, _, _) in funcs:
             if listing.getInstructionAt(addr) is not None:
                 disasm_ok += 1
             else:
-                disasm_fail += 1
-        except:
-            disasm_fail += 1
+                pending.append(addr)
+        if pending:
+            # One DisassembleCommand over the whole set instead of a
+            # disassemble() call (and its scheduling/locking) per address.
+            try:
+                aset = address_set(pending)
+                clearListing(aset)
+                DisassembleCommand(aset, None, True).applyTo(currentProgram, monitor)
+            except Exception as e:
+                println("  WARN: bulk disassembly failed: %s" % str(e)[:120])
+            for addr in pending:
+                if listing.getInstructionAt(addr) is not None:
+                    disasm_ok += 1
+                else:
+                    disasm_fail += 1
+    del pending
     println("  disassembled=%d failed=%d" % (disasm_ok, disasm_fail))
 
     # Phase 1b: Create/rename functions.
     println("Phase 1b: creating/renaming %d functions..." % stats["functions"])
-    for entry in meta.get("functions", []):
-        addr_int = int(entry["addr"], 16) + image_base
-        addr = toAddr(addr_int)
-        name = entry["name"]
-
-        fn = fm.getFunctionAt(addr)
-        if fn is not None:
-            try:
-                fn.setName(name, SourceType.USER_DEFINED)
-                stats["renamed"] += 1
-            except:
-                pass
-            continue
+    with bulk(currentProgram, "unflutter: create functions"):
+        # created_fns doubles as the verify pass: it holds every function that
+        # exists at one of our addresses once this phase is done.
+        created_fns = {}  # addr_str -> Function
+        retry = []
+        for (addr, name, owner, _, addr_str) in funcs:
+            fn = fm.getFunctionAt(addr)
+            if fn is not None:
+                created_fns[addr_str] = fn
+                try:
+                    fn.setName(name, SourceType.USER_DEFINED)
+                    stats["renamed"] += 1
+                except:
+                    pass
+                continue
 
-        # Try to create function.
-        try:
-            fn = createFunction(addr, name)
+            # Try to create function.
+            fn = create_function(currentProgram, addr, name)
             if fn is not None:
+                created_fns[addr_str] = fn
                 stats["created"] += 1
                 continue
-        except:
-            pass
+            retry.append((addr, name, owner, addr_str))
 
-        # Fallback: disassemble at the address, then try again.
-        try:
-            disassemble(addr)
-            fn = createFunction(addr, name)
+        # Fallback: disassemble all failed addresses in one pass, then try again.
+        if retry:
+            try:
+                aset = address_set([addr for (addr, _, _, _) in retry])
+                DisassembleCommand(aset, None, True).applyTo(currentProgram, monitor)
+            except:
+                pass
+
+        ns_by_owner = {}  # owner -> Dart::<owner> Namespace
+        for (addr, name, owner, addr_str) in retry:
+            fn = create_function(currentProgram, addr, name)
             if fn is not None:
+                created_fns[addr_str] = fn
                 stats["created"] += 1
                 continue
-        except:
-            pass
 
-        # Last resort: create a label so the name appears.
-        try:
-            symtab.createLabel(addr, name, SourceType.USER_DEFINED)
-            stats["labels"] += 1
-        except:
-            stats["create_failed"] += 1
+            # Last resort: create a label so the name appears, scoped to its
+            # class so it does not compete with every other global label.
+            try:
+                ns = class_namespace(currentProgram, owner, ns_by_owner)
+                symtab.createLabel(addr, name, ns, SourceType.USER_DEFINED)
+                stats["labels"] += 1
+            except:
+                stats["create_failed"] += 1
 
     println("  created=%d renamed=%d labels=%d failed=%d" % (
         stats["created"], stats["renamed"], stats["labels"], stats["create_failed"]))
 
-    # Verify: count how many functions exist now at our addresses.
-    verify_count = 0
-    for entry in meta.get("functions", []):
-        addr = toAddr(int(entry["addr"], 16) + image_base)
-        if fm.getFunctionAt(addr) is not None:
-            verify_count += 1
-    println("  verified: %d/%d addresses have functions" % (verify_count, stats["functions"]))
+    println("  verified: %d/%d addresses have functions" % (len(created_fns), stats["functions"]))
+    del retry
+
+    # Phase 2: Set EOL comments.
+    # Runs ahead of Phase 1c because sections are consumed in file order
+    # (functions, comments, focus_functions, classes, thr_fields); comments
+    # do not depend on the struct types.
+    # Apply in address order for better locality in the comment table.
+    comments = sorted((int(e["addr"], 16), e["text"]) for e in comments_meta)
+    println("Phase 2: setting %d comments..." % len(comments))
+    with bulk(currentProgram, "unflutter: comments"):
+        for (offset, text) in comments:
+            try:
+                listing.setComment(dspace.getAddress(offset + image_base), CodeUnit.EOL_COMMENT, text)
+                stats["comments"] += 1
+            except:
+                stats["comment_failed"] += 1
+
+    println("  set=%d failed=%d" % (stats["comments"], stats["comment_failed"]))
+    del comments
+
+    # Focus list for Phase 3: just address strings, read now to stay in
+    # file order.
+    focus = list(focus_meta)
 
     # Phase 1c: Create struct types for Dart classes.
     # Must run BEFORE param application so typed 'this' pointers can reference structs.
-    classes = meta.get("classes", [])
-    struct_by_owner = {}  # class_name -> Ghidra DataType
-    if classes:
-        println("Phase 1c: creating %d class struct types..." % len(classes))
-        dtm = currentProgram.getDataTypeManager()
-        cat = CategoryPath("/DartClasses")
-        struct_created = 0
-        struct_failed = 0
-
-        for cls in classes:
+    # Classes are streamed straight from the metadata; only the built
+    # structs are held until the bulk add.
+    struct_by_owner = HashMap()  # class_name -> Ghidra DataType
+    println("Phase 1c: creating class struct types...")
+    dtm = currentProgram.getDataTypeManager()
+    cat = CategoryPath("/DartClasses")
+    class_count = 0
+    struct_created = 0
+    struct_failed = 0
+
+    # Build every struct first, then resolve them in one addDataTypes call
+    # so the manager lock and change events are taken once, not per class.
+    pending = ArrayList()
+    pending_names = []  # (class_name, struct_name), parallel to pending
+    with bulk(currentProgram, "unflutter: class structs"):
+        for cls in classes_meta:
+            class_count += 1
             try:
                 cname = cls["class_name"]
                 sname = "Dart_" + sanitize(cname)
                 size = cls["instance_size"]
                 if size <= 0:
                     continue
-                fields = cls.get("fields", [])
-
-                struct_dt = StructureDataType(cat, sname, size)
-                for field in fields:
-                    offset = field["byte_offset"]
-                    fname = field["name"]
-                    if offset >= 0 and offset + pointer_size <= size:
-                        struct_dt.replaceAtOffset(offset, field_type, pointer_size, fname, "")
+                fields = [(f["byte_offset"], f["name"]) for f in cls.get("fields", [])]
 
-                resolved = dtm.addDataType(struct_dt, REPLACE_HANDLER)
-                struct_by_owner[cname] = resolved
-                struct_created += 1
+                struct_dt, _ = build_struct(cat, sname, size, fields, field_type, pointer_size)
+                pending.add(struct_dt)
+                pending_names.append((cname, sname))
             except Exception as e:
                 struct_failed += 1
                 if struct_failed <= 5:
                     println("  WARN: struct %s: %s" % (cls.get("class_name", "?"), str(e)[:80]))
 
-        println("  structs created=%d failed=%d (lookup=%d)" % (struct_created, struct_failed, len(struct_by_owner)))
+        if pending_names:
+            try:
+                dtm.addDataTypes(pending, REPLACE_HANDLER, monitor)
+            except Exception as e:
+                println("  WARN: adding structs failed: %s" % str(e)[:120])
+        for (cname, sname) in pending_names:
+            resolved = dtm.getDataType(cat, sname)
+            if resolved is not None:
+                struct_by_owner.put(cname, resolved)
+                struct_created += 1
+            else:
+                struct_failed += 1
+    del pending, pending_names
+
+    if class_count:
+        println("  classes=%d structs created=%d failed=%d (lookup=%d)" % (
+            class_count, struct_created, struct_failed, struct_by_owner.size()))
     else:
-        println("Phase 1c: skipped (no class layouts)")
+        println("  skipped (no class layouts)")
+
+    # One 'this' pointer type per class, shared by all of its methods.
+    this_ptr_by_owner = HashMap()
+    for e in struct_by_owner.entrySet():
+        this_ptr_by_owner.put(e.getKey(), PointerDataType(e.getValue()))
 
     # Phase 1c2: Create DartThread struct from THR fields.
-    thr_fields = meta.get("thr_fields", [])
+    thr_fields = list(thr_meta)
     if thr_fields:
         println("Phase 1c2: creating DartThread struct (%d fields)..." % len(thr_fields))
         dtm = currentProgram.getDataTypeManager()
@@ -211,20 +318,16 @@ def main():
             # Find max offset to determine struct size.
             max_off = max(f["offset"] for f in thr_fields)
             thr_size = max_off + 8  # last field is a pointer
-            thr_dt = StructureDataType(cat, "DartThread", thr_size)
-            thr_placed = 0
-            for tf in thr_fields:
-                off = tf["offset"]
-                tname = tf["name"]
-                if off >= 0 and off + 8 <= thr_size:
-                    thr_dt.replaceAtOffset(off, ptr_type, 8, tname, "")
-                    thr_placed += 1
-            dtm.addDataType(thr_dt, REPLACE_HANDLER)
+            with bulk(currentProgram, "unflutter: thread struct"):
+                thr_dt, thr_placed = build_struct(cat, "DartThread", thr_size,
+                    [(tf["offset"], tf["name"]) for tf in thr_fields], ptr_type, 8)
+                dtm.addDataType(thr_dt, REPLACE_HANDLER)
             println("  DartThread: %d/%d fields placed (size=%d)" % (thr_placed, len(thr_fields), thr_size))
         except Exception as e:
             println("  WARN: DartThread creation failed: %s" % str(e)[:120])
     else:
         println("Phase 1c2: skipped (no THR fields)")
+    del thr_fields
 
     # Phase 1d: Apply function signatures (typed parameters + return type).
     # For methods (functions with an owner class):
@@ -235,176 +338,169 @@ def main():
     println("Phase 1d: applying function signatures...")
     sig_applied = 0
     sig_failed = 0
+    sig_skipped = 0
     ret_applied = 0
     this_typed = 0
-    for entry in meta.get("functions", []):
-        addr = toAddr(int(entry["addr"], 16) + image_base)
-        fn = fm.getFunctionAt(addr)
-        if fn is None:
-            continue
-
-        owner = entry.get("owner", "")
-        pc = entry.get("param_count", 0)
-
-        # Set return type to pointer (Dart returns objects, not undefined).
-        try:
-            fn.setReturnType(ptr_type, SourceType.USER_DEFINED)
-            ret_applied += 1
-        except:
-            pass
-
-        # Build parameter list.
-        params = []
+    with bulk(currentProgram, "unflutter: signatures"):
+        for (_, _, owner, pc, addr_str) in funcs:
+            fn = created_fns.get(addr_str)
+            if fn is None:
+                continue
 
-        # Methods get typed 'this' as first parameter.
-        # param_count excludes implicit 'this', so we add it separately.
-        if owner:
-            if owner in struct_by_owner:
-                this_dt = PointerDataType(struct_by_owner[owner])
-                this_typed += 1
-            else:
-                this_dt = ptr_type
-            params.append(ParameterImpl("this", this_dt, currentProgram))
+            # Methods get typed 'this' as first parameter.
+            # param_count excludes implicit 'this', so we add it separately.
+            this_dt = None
+            if owner:
+                this_dt = this_ptr_by_owner.get(owner)
+                if this_dt is not None:
+                    this_typed += 1
+                else:
+                    this_dt = ptr_type
+
+            # Reruns against an existing project already carry these
+            # signatures; replaceParameters is the expensive path.
+            if signature_matches(fn, ptr_type, this_dt, pc):
+                sig_skipped += 1
+                continue
 
-        # Explicit parameters.
-        for i in range(pc):
-            params.append(ParameterImpl("p%d" % i, ptr_type, currentProgram))
+            # Set return type to pointer (Dart returns objects, not undefined).
+            try:
+                fn.setReturnType(ptr_type, SourceType.USER_DEFINED)
+                ret_applied += 1
+            except:
+                pass
 
-        if not params:
-            continue
+            # Build parameter list.
+            params = []
+            if this_dt is not None:
+                params.append(ParameterImpl("this", this_dt, currentProgram))
 
-        try:
-            fn.replaceParameters(params,
-                GhidraFunction.FunctionUpdateType.DYNAMIC_STORAGE_ALL_PARAMS,
-                True, SourceType.USER_DEFINED)
-            sig_applied += 1
-        except:
-            sig_failed += 1
+            # Explicit parameters.
+            for i in range(pc):
+                params.append(ParameterImpl("p%d" % i, ptr_type, currentProgram))
 
-    println("  signatures applied=%d failed=%d return_types=%d this_typed=%d" % (
-        sig_applied, sig_failed, ret_applied, this_typed))
+            if not params:
+                continue
 
-    # Phase 2: Set EOL comments.
-    comment_entries = meta.get("comments", [])
-    println("Phase 2: setting %d comments..." % len(comment_entries))
-    for entry in comment_entries:
-        addr_int = int(entry["addr"], 16) + image_base
-        addr = toAddr(addr_int)
-        text = entry["text"]
-        try:
-            setEOLComment(addr, text)
-            stats["comments"] += 1
-        except:
-            stats["comment_failed"] += 1
+            try:
+                fn.replaceParameters(params,
+                    GhidraFunction.FunctionUpdateType.DYNAMIC_STORAGE_ALL_PARAMS,
+                    True, SourceType.USER_DEFINED)
+                sig_applied += 1
+            except:
+                sig_failed += 1
 
-    println("  set=%d failed=%d" % (stats["comments"], stats["comment_failed"]))
+    println("  signatures applied=%d failed=%d unchanged=%d return_types=%d this_typed=%d" % (
+        sig_applied, sig_failed, sig_skipped, ret_applied, this_typed))
+    del funcs, created_fns
 
     # Phase 3: Selective decompilation.
-    # Build addr → owner lookup for directory grouping.
-    owner_by_addr = {}
-    for entry in meta.get("functions", []):
-        owner = entry.get("owner", "")
-        if owner:
-            owner_by_addr[entry["addr"]] = owner
-
-    focus = meta.get("focus_functions", [])
     if out_dir and focus:
         println("Phase 3: decompiling %d focus functions..." % len(focus))
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-
-        ifc = DecompInterface()
-        ifc.openProgram(currentProgram)
-
-        index = []
-        not_found = 0
+        # Directories already created, shared with the writer thread.
+        made_dirs = set()
+        ensure_dir(out_dir, made_dirs)
+
+        # Resolve focus addresses to functions and output files up front.
+        # Several focus addresses may land in the same function; decompile
+        # it once and write it under each of their names.
+        fn_by_focus = {}
+        name_by_key = {}  # entry -> function name, for records the writer never sees
+        out_files_by_key = {}  # entry -> [(addr_str, out_file)]
+        too_large = set()
+        # Functions grouped by decompile timeout (see decompile_timeout).
+        batches = {}
         for addr_str in focus:
-            addr_int = int(addr_str, 16) + image_base
-            addr = toAddr(addr_int)
+            addr = addr_by_str.get(addr_str)
+            if addr is None:
+                addr = mkaddr(addr_str)
 
             # Try exact match first, then containing.
             fn = fm.getFunctionAt(addr)
             if fn is None:
                 fn = fm.getFunctionContaining(addr)
-
             if fn is None:
-                not_found += 1
-                if not_found <= 5:
-                    println("  WARN: no function at %s" % addr_str)
-                index.append({
-                    "addr": addr_str,
-                    "name": "unknown",
-                    "file": None,
-                    "decompile_ok": False,
-                    "reason": "no_function",
-                })
-                stats["decompile_failed"] += 1
                 continue
-
-            fn_name = fn.getName()
+            key = fn.getEntryPoint().getOffset()
+            fn_by_focus[addr_str] = key
+
+            safe_name = addr_str.replace("0x", "") + "_" + sanitize(fn.getName())
+            # Use owner-based subdirectory if available.
+            owner = owner_by_addr.get(addr_str)
+            if owner:
+                out_file = os.path.join(sanitize(owner), safe_name + ".c")
+            else:
+                out_file = safe_name + ".c"
+            if key not in out_files_by_key:
+                out_files_by_key[key] = []
+                name_by_key[key] = fn.getName()
+                # Skip pathological functions so one of them cannot stall
+                # the phase; give small ones a short leash.
+                size = fn.getBody().getNumAddresses()
+                if size > MAX_DECOMPILE_SIZE:
+                    too_large.add(key)
+                else:
+                    batches.setdefault(decompile_timeout(size), ArrayList()).add(fn)
+            out_files_by_key[key].append((addr_str, out_file))
+
+        # Decompile across all cores: each worker thread owns a DecompInterface
+        # and hands finished C text to a single writer thread, so file IO
+        # overlaps with decompilation and never runs on a decompiler worker.
+        # The writer also appends each index record to index.jsonl as it
+        # goes, so a crashed run keeps what it finished. Records land in
+        # completion order; index_offsets (addr -> byte offset of its record)
+        # lets finish_index put them back in focus order.
+        index_tmp_path = os.path.join(out_dir, "index.jsonl")
+        index_offsets = {}
+        index_out = open(index_tmp_path, "w")
+        try:
+            # Keys the writer has recorded. Only the writer adds to it, and it
+            # is read here after the writer has been joined.
+            handled = set()
+            wq = Queue()
+            # Build the callback before starting the writer: if either
+            # constructor throws, no thread is left waiting on the queue.
+            callback = FocusDecompileCallback(currentProgram, FocusDecompileConfigurer(currentProgram), wq)
+            writer = threading.Thread(target=write_files,
+                                      args=(wq, out_dir, made_dirs, out_files_by_key,
+                                            index_out, index_offsets, stats, handled))
+            writer.start()
             try:
-                result = ifc.decompileFunction(fn, 60, monitor)
-            except Exception as e:
-                index.append({
-                    "addr": addr_str,
-                    "name": fn_name,
-                    "file": None,
-                    "decompile_ok": False,
-                    "reason": str(e)[:100],
-                })
-                stats["decompile_failed"] += 1
-                continue
-
-            if result and result.decompileCompleted():
-                decomp = result.getDecompiledFunction()
-                if decomp:
-                    c_code = decomp.getC()
-                    safe_name = addr_str.replace("0x", "") + "_" + sanitize(fn_name)
-                    # Use owner-based subdirectory if available.
-                    owner = owner_by_addr.get(addr_str, "")
-                    if owner:
-                        sub_dir = os.path.join(out_dir, sanitize(owner))
-                        if not os.path.exists(sub_dir):
-                            os.makedirs(sub_dir)
-                        out_file = os.path.join(sanitize(owner), safe_name + ".c")
-                    else:
-                        out_file = safe_name + ".c"
-                    out_path = os.path.join(out_dir, out_file)
-                    with open(out_path, "w") as cf:
-                        cf.write(c_code)
-                    index.append({
-                        "addr": addr_str,
-                        "name": fn_name,
-                        "file": out_file,
-                        "decompile_ok": True,
-                    })
-                    stats["decompiled"] += 1
-                    continue
-
-            reason = "decompile_incomplete"
-            if result:
-                err_msg = result.getErrorMessage()
-                if err_msg:
-                    reason = err_msg[:100]
-
-            index.append({
-                "addr": addr_str,
-                "name": fn_name,
-                "file": None,
-                "decompile_ok": False,
-                "reason": reason,
-            })
-            stats["decompile_failed"] += 1
+                for timeout in sorted(batches):
+                    callback.setTimeout(timeout)
+                    try:
+                        ParallelDecompiler.decompileFunctions(callback, currentProgram, batches[timeout], monitor)
+                    except Exception as e:
+                        println("  WARN: decompile batch (timeout=%ds) aborted: %s" % (timeout, str(e)[:120]))
+            finally:
+                callback.dispose()
+                wq.put(None)
+                writer.join()
+
+            # Record the focus addresses the writer never saw.
+            not_found = 0
+            for addr_str in focus:
+                key = fn_by_focus.get(addr_str)
+                if key is None:
+                    not_found += 1
+                    if not_found <= 5:
+                        println("  WARN: no function at %s" % addr_str)
+                    write_index_record(index_out, index_offsets,
+                                       index_record(addr_str, "unknown", reason="no_function"), stats)
+                elif key not in handled:
+                    reason = "too_large" if key in too_large else "decompile_cancelled"
+                    write_index_record(index_out, index_offsets,
+                                       index_record(addr_str, name_by_key[key], reason=reason), stats)
+        finally:
+            index_out.close()
 
         if not_found > 0:
             println("  %d focus functions not found" % not_found)
-
-        ifc.dispose()
+        if too_large:
+            println("  %d focus functions skipped (over %d bytes)" % (len(too_large), MAX_DECOMPILE_SIZE))
 
         # Write index.json.
-        index_path = os.path.join(out_dir, "index.json")
-        with open(index_path, "w") as idx:
-            json.dump(index, idx, indent=2)
+        finish_index(index_tmp_path, os.path.join(out_dir, "index.json"), focus, index_offsets)
         println("  decompiled=%d failed=%d" % (stats["decompiled"], stats["decompile_failed"]))
     elif focus:
         println("Phase 3: skipped (no output directory specified)")
@@ -423,17 +519,357 @@ def main():
     ))
 
 
-def sanitize(name):
-    """Sanitize a function name for use as a filename."""
-    out = []
-    for ch in name:
-        if ch.isalnum() or ch in ("_", "-", "."):
-            out.append(ch)
+class FocusDecompileConfigurer(DecompileConfigurer):
+    """Configures each worker's DecompInterface before it opens the program.
+
+    The options are read from the program once and shared by every worker.
+    Only C text is consumed, so the syntax tree is not materialized.
+    """
+
+    def __init__(self, program):
+        self.opts = DecompileOptions()
+        self.opts.grabFromProgram(program)
+
+    def configure(self, decompiler):
+        decompiler.setOptions(self.opts)
+        decompiler.toggleCCode(True)
+        decompiler.toggleSyntaxTree(False)
+        decompiler.setSimplificationStyle("decompile")
+
+
+class FocusDecompileCallback(DecompilerCallback):
+    """Runs on decompiler worker threads and returns the function entry.
+
+    Each result goes onto the writer queue as (entry, name, c_code, reason):
+    c_code is None on failure, in which case reason explains why.
+    """
+
+    def __init__(self, program, configurer, queue):
+        DecompilerCallback.__init__(self, program, configurer)
+        self.queue = queue
+
+    def process(self, item, monitor):
+        # A Python method replaces every Java overload of the same name, so
+        # this also receives ParallelDecompiler's process(Function, monitor).
+        # Hand that to the superclass, which decompiles and calls back here
+        # with the DecompileResults.
+        if not isinstance(item, DecompileResults):
+            return DecompilerCallback.process(self, item, monitor)
+
+        result = item
+        fn = result.getFunction()
+        key = fn.getEntryPoint().getOffset()
+        fn_name = fn.getName()
+        if result.decompileCompleted():
+            decomp = result.getDecompiledFunction()
+            if decomp:
+                self.queue.put((key, fn_name, decomp.getC(), None))
+                return key
+
+        reason = "decompile_incomplete"
+        err_msg = result.getErrorMessage()
+        if err_msg:
+            reason = err_msg[:100]
+        self.queue.put((key, fn_name, None, reason))
+        return key
+
+
+def decompile_timeout(size):
+    """Decompile timeout in seconds for a function body of size bytes."""
+    if size < 500:
+        return 10
+    if size < 5000:
+        return 30
+    return 120
+
+
+def write_files(queue, out_dir, made_dirs, out_files_by_key, index_out, index_offsets, stats, handled):
+    """Writer thread: write each queued result to all of its focus files.
+
+    Stops at a None item. Every focus address of the result gets an index
+    record in index_out, and the result's entry is added to handled.
+    made_dirs is the ensure_dir cache of directories already created.
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        key, fn_name, c_code, reason = item
+        if key in handled:
+            continue
+        handled.add(key)
+        for (addr_str, out_file) in out_files_by_key.get(key, ()):
+            if c_code is None:
+                rec = index_record(addr_str, fn_name, reason=reason)
+            else:
+                out_path = os.path.join(out_dir, out_file)
+                try:
+                    ensure_dir(os.path.dirname(out_path), made_dirs)
+                    with open(out_path, "w") as cf:
+                        cf.write(c_code)
+                    rec = index_record(addr_str, fn_name, out_file=out_file)
+                except Exception:
+                    rec = index_record(addr_str, fn_name, reason="write_failed")
+            write_index_record(index_out, index_offsets, rec, stats)
+
+
+def index_record(addr_str, name, out_file=None, reason=None):
+    """Build an index.json entry; entries without out_file are failures."""
+    if out_file is not None:
+        return {
+            "addr": addr_str,
+            "name": name,
+            "file": out_file,
+            "decompile_ok": True,
+        }
+    return {
+        "addr": addr_str,
+        "name": name,
+        "file": None,
+        "decompile_ok": False,
+        "reason": reason,
+    }
+
+
+def write_index_record(index_out, index_offsets, rec, stats):
+    """Append rec to the index.jsonl stream and count it in stats.
+
+    The record's byte offset is stored in index_offsets under its addr.
+    """
+    index_offsets[rec["addr"]] = index_out.tell()
+    index_out.write(json.dumps(rec) + "\n")
+    index_out.flush()
+    if rec["decompile_ok"]:
+        stats["decompiled"] += 1
+    else:
+        stats["decompile_failed"] += 1
+
+
+def finish_index(jsonl_path, json_path, order, index_offsets):
+    """Turn index.jsonl into the index.json array, then drop the .jsonl.
+
+    Records are emitted in the order of the addrs in order, read from the
+    byte offsets write_index_record stored in index_offsets.
+    """
+    with open(jsonl_path, "r") as src:
+        with open(json_path, "w") as dst:
+            dst.write("[")
+            sep = "\n  "
+            for addr_str in order:
+                offset = index_offsets.get(addr_str)
+                if offset is None:
+                    continue
+                src.seek(offset)
+                dst.write(sep + src.readline().strip())
+                sep = ",\n  "
+            dst.write("\n]\n")
+    os.remove(jsonl_path)
+
+
+@contextmanager
+def bulk(program, name):
+    """Run a block of database edits in one transaction with events muted.
+
+    Each phase applies thousands of small edits; without this every one of
+    them records its own change and fires domain-object events. The
+    headless script transaction still commits everything at exit.
+    """
+    program.setEventsEnabled(False)
+    tid = program.startTransaction(name)
+    try:
+        yield
+    finally:
+        program.endTransaction(tid, True)
+        program.setEventsEnabled(True)
+
+
+class MetaReader(object):
+    """Section-by-section access to ghidra_meta.json.
+
+    With ijson available the file is parsed in a single forward pass. A
+    section asked for before the parser has reached it is streamed item by
+    item, so its records are never all resident at once. Sections the
+    parser passes while looking for another one are buffered until their
+    phase asks for them. Without ijson the whole file is loaded once with
+    json.load.
+    """
+
+    def __init__(self, path):
+        self.meta = None
+        self._events = None
+        self._scalars = {}
+        self._buffered = {}
+        if ijson is None:
+            with open(path, "r") as f:
+                self.meta = json.load(f)
         else:
-            out.append("_")
-    s = "".join(out)
-    if len(s) > 120:
-        s = s[:120]
+            self._file = open(path, "rb")
+            self._events = ijson.parse(self._file)
+
+    def items(self, key):
+        """Iterate the elements of the top-level list named key."""
+        if self.meta is not None:
+            return iter(self.meta.get(key) or [])
+        return self._section(key)
+
+    def get(self, key, default=None):
+        """Return a top-level scalar value."""
+        if self.meta is not None:
+            return self.meta.get(key, default)
+        while key not in self._scalars:
+            section = self._next_section()
+            if section is None:
+                return self._scalars.get(key, default)
+            self._buffered[section] = list(self._read_items(section))
+        return self._scalars[key]
+
+    def _section(self, key):
+        while key not in self._buffered:
+            section = self._next_section()
+            if section is None:
+                return
+            if section == key:
+                for item in self._read_items(key):
+                    yield item
+                return
+            self._buffered[section] = list(self._read_items(section))
+        for item in self._buffered.pop(key):
+            yield item
+
+    def _next_section(self):
+        """Advance to the next top-level list and return its key.
+
+        Top-level scalars passed on the way are kept for get(). Returns
+        None, and closes the file, at end of input.
+        """
+        for prefix, event, value in self._events:
+            if not prefix or "." in prefix:
+                continue
+            if event == "start_array":
+                return prefix
+            if event in ("string", "number", "boolean", "null"):
+                self._scalars[prefix] = value
+        self._file.close()
+        return None
+
+    def _read_items(self, key):
+        """Yield the items of the list the parser has just entered."""
+        item_prefix = key + ".item"
+        for prefix, event, value in self._events:
+            if prefix == key and event == "end_array":
+                return
+            if prefix != item_prefix:
+                continue
+            if event not in ("start_map", "start_array"):
+                yield value
+                continue
+            builder = ijson.common.ObjectBuilder()
+            depth = 1
+            while depth:
+                builder.event(event, value)
+                prefix, event, value = next(self._events)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+            yield builder.value
+
+
+def build_struct(cat, name, size, fields, field_dt, field_size):
+    """Build a size-byte struct by appending (offset, name) fields in order.
+
+    Appending avoids replaceAtOffset, which re-packs the component array of
+    a default-filled struct on every call. Gaps become undefined bytes;
+    fields that overlap an earlier one or run past size are skipped with a
+    warning. Returns (struct, number_of_fields_placed).
+    """
+    struct_dt = StructureDataType(cat, name, 0)
+    cursor = 0
+    placed = 0
+    for (offset, fname) in sorted(fields):
+        if offset < cursor or offset + field_size > size:
+            println("  WARN: %s.%s at 0x%x skipped (%s)" % (
+                name, fname, offset, "overlaps previous field" if offset < cursor else "past struct size"))
+            continue
+        if offset > cursor:
+            struct_dt.growStructure(offset - cursor)
+        struct_dt.add(field_dt, field_size, fname, "")
+        cursor = offset + field_size
+        placed += 1
+    if size > cursor:
+        struct_dt.growStructure(size - cursor)
+    return struct_dt, placed
+
+
+def signature_matches(fn, ret_dt, this_dt, param_count):
+    """Report whether fn already has the signature Phase 1d would apply.
+
+    this_dt is None for functions without an owner class.
+    """
+    if not ret_dt.isEquivalent(fn.getReturnType()):
+        return False
+    expected = param_count + (0 if this_dt is None else 1)
+    if fn.getParameterCount() != expected:
+        return False
+    if this_dt is not None and not this_dt.isEquivalent(fn.getParameter(0).getDataType()):
+        return False
+    return True
+
+
+def address_set(addrs):
+    """Build an AddressSet covering each address in addrs."""
+    aset = AddressSet()
+    for addr in addrs:
+        aset.add(addr)
+    return aset
+
+
+def class_namespace(program, owner, cache):
+    """Return the Dart::<owner> namespace, creating it on first use.
+
+    Functions without an owner, or whose namespace cannot be created, go in
+    the global namespace.
+    """
+    global_ns = program.getGlobalNamespace()
+    if not owner:
+        return global_ns
+    ns = cache.get(owner)
+    if ns is None:
+        symtab = program.getSymbolTable()
+        try:
+            dart_ns = symtab.getOrCreateNameSpace(global_ns, "Dart", SourceType.USER_DEFINED)
+            ns = symtab.getOrCreateNameSpace(dart_ns, sanitize(owner), SourceType.USER_DEFINED)
+        except:
+            ns = global_ns
+        cache[owner] = ns
+    return ns
+
+
+def create_function(program, addr, name):
+    """Create a user-defined function at addr; returns None on failure."""
+    try:
+        cmd = CreateFunctionCmd(name, addr, None, SourceType.USER_DEFINED)
+        if cmd.applyTo(program):
+            return cmd.getFunction()
+    except:
+        pass
+    return None
+
+
+def ensure_dir(path, made_dirs):
+    """Create path if needed, touching the filesystem once per directory."""
+    if path not in made_dirs:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        made_dirs.add(path)
+
+
+def sanitize(name, _cache=_sanitize_cache):
+    """Sanitize a function name for use as a filename."""
+    s = _cache.get(name)
+    if s is None:
+        s = _UNSAFE_CHARS.sub("_", name)[:120]
+        _cache[name] = s
     return s
 
 
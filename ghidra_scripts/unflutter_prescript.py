@@ -10,6 +10,16 @@
 # Usage:
 #   analyzeHeadless ... -preScript unflutter_prescript.py -postScript unflutter_apply.py ...
 
+HEAVY_ANALYZERS = (
+    "Decompiler Parameter ID",
+    "Stack",
+    "Shared Return Calls",
+    "Call Convention ID",
+    "Create Address Tables",
+    "ASCII Strings",
+)
+
+
 def main():
     println("unflutter_prescript: configuring analysis for Dart AOT binary")
 
@@ -29,6 +39,23 @@ def main():
     except Exception as e:
         println("  WARN: could not disable Non-Returning Functions - Discovered: %s" % str(e)[:60])
 
+    # Analyzers that spend most of the pre-script phase on work unflutter_apply
+    # redoes or that does not fit Dart AOT code: parameter and calling
+    # convention recovery (signatures come from ghidra_meta.json), stack
+    # frames, shared-return call splitting, address tables and string
+    # scanning over dense code pages.
+    for opt in HEAVY_ANALYZERS:
+        try:
+            setAnalysisOption(currentProgram, opt, "false")
+            println("  disabled: %s" % opt)
+        except Exception as e:
+            println("  WARN: could not disable %s: %s" % (opt, str(e)[:60]))
+
+    # Echo the effective settings so the headless log shows what ran.
+    current = getCurrentAnalysisOptionsAndValues(currentProgram)
+    for opt in HEAVY_ANALYZERS:
+        println("  %s = %s" % (opt, current.get(opt)))
+
     println("unflutter_prescript: done")
 
 